@@ -24,6 +24,7 @@ import jax
 import jax.numpy as jnp
 from jax_verify.src.mip_solver import relaxation
 import numpy as np
+from scipy import sparse
 
 _EPS = 1e-10
 CvxpyConstraint = cp.constraints.constraint.Constraint
@@ -42,6 +43,17 @@ class CvxpySolver(relaxation.RelaxationSolver):
     self.solver_variables: Dict[str, cp.Variable] = {}
     self.constraints: List[CvxpyConstraint] = []
     self.problem_kwargs = {}
+    self._variable_bounds: Dict[str, Tuple[cp.Parameter, cp.Parameter]] = {}
+    # Parametrized problems, used to optimize over each variable, kept along
+    # with the number of constraints they were built with.
+    self._problems: Dict[str, Tuple[int, cp.Parameter, cp.Problem]] = {}
+
+  def __getstate__(self):
+    # The cached problems are only a speed-up, and are large to pickle, so
+    # they are not sent along with the solver.
+    state = self.__dict__.copy()
+    state['_problems'] = {}
+    return state
 
   def _variable_already_created(self, var: Variable) -> bool:
     return var.name in self.solver_variables
@@ -59,9 +71,30 @@ class CvxpySolver(relaxation.RelaxationSolver):
     lower = np.reshape(relax_var.lower[index, ...], [-1])
     upper = np.reshape(relax_var.upper[index, ...], [-1])
     var = cp.Variable(lower.shape)
-    self.constraints += [lower <= var]
-    self.constraints += [var <= upper]
+    # The bounds are parameters, so that they can be updated without having
+    # to rebuild the problem.
+    lower_param = cp.Parameter(lower.shape, value=np.asarray(lower))
+    upper_param = cp.Parameter(upper.shape, value=np.asarray(upper))
+    self.constraints += [lower_param <= var]
+    self.constraints += [var <= upper_param]
     self.solver_variables[relax_var.name] = var
+    self._variable_bounds[relax_var.name] = (lower_param, upper_param)
+
+  def update_variable_bounds(
+      self,
+      var_name: str,
+      lower: Tensor,
+      upper: Tensor):
+    """Update the bounds of an already created variable.
+
+    Args:
+      var_name: Name of the variable to update.
+      lower: New lower bounds on the (flattened) variable.
+      upper: New upper bounds on the (flattened) variable.
+    """
+    lower_param, upper_param = self._variable_bounds[var_name]
+    lower_param.value = np.maximum(lower_param.value, lower)
+    upper_param.value = np.minimum(upper_param.value, upper)
 
   def create_linear_solver_constraint(self,
                                       constraint: relaxation.LinearConstraint,
@@ -73,13 +106,16 @@ class CvxpySolver(relaxation.RelaxationSolver):
       index: Index in the batch for which to build the variable.
     """
     rhs = cp.expressions.constants.Constant(constraint.bias(index))
-    for (constraint_variable,
-         (cpts, coeffs)) in constraint.vars_and_coeffs(index):
+    coeffs = constraint.coeffs(index)
+    for constraint_variable, start, end in zip(
+        constraint.variables, constraint.offsets[:-1], constraint.offsets[1:]):
       if isinstance(constraint_variable, relaxation.RelaxVariable):
         current_variable = self.solver_variables[constraint_variable.name]
-        for component, coeff in zip(cpts, coeffs):
-          if np.abs(coeff) > _EPS:
-            rhs += current_variable[component] * coeff.item()
+        var_cpts = constraint.components[start:end]
+        var_coeffs = coeffs[start:end]
+        used = np.abs(var_coeffs) > _EPS
+        if np.any(used):
+          rhs += var_coeffs[used] @ current_variable[var_cpts[used]]
     if constraint.sense == 0:
       self.constraints += [rhs == 0]
     if constraint.sense == 1:
@@ -87,6 +123,56 @@ class CvxpySolver(relaxation.RelaxationSolver):
     if constraint.sense == -1:
       self.constraints += [rhs >= 0]
 
+  def create_linear_solver_constraints_batch(
+      self,
+      constraints: List[relaxation.LinearConstraint],
+      index: int):
+    """Create several CVXPY linear constraints at once.
+
+    The constraints of each sense are gathered into a single sparse matrix
+    for each of the variables involved, and added as one vector constraint.
+
+    Args:
+      constraints: Constraints generated by the relaxation bound propagation.
+      index: Index in the batch for which to build the variable.
+    """
+    for sense in (0, 1, -1):
+      sense_constraints = [constraint for constraint in constraints
+                           if constraint.sense == sense]
+      if not sense_constraints:
+        continue
+      # Coordinates of the coefficients, in CSR format, for each variable.
+      rows, cols, data = {}, {}, {}
+      for row, constraint in enumerate(sense_constraints):
+        coeffs = constraint.coeffs(index)
+        for constraint_variable, start, end in zip(
+            constraint.variables, constraint.offsets[:-1],
+            constraint.offsets[1:]):
+          if isinstance(constraint_variable, relaxation.RelaxVariable):
+            name = constraint_variable.name
+            rows.setdefault(name, []).append(np.full(end - start, row))
+            cols.setdefault(name, []).append(constraint.components[start:end])
+            data.setdefault(name, []).append(coeffs[start:end])
+      rhs = cp.expressions.constants.Constant(np.array(
+          [constraint.bias(index) for constraint in sense_constraints],
+          dtype=np.float64))
+      for name in rows:
+        var_rows = np.concatenate(rows[name])
+        var_cols = np.concatenate(cols[name])
+        var_data = np.concatenate(data[name])
+        used = np.abs(var_data) > _EPS
+        current_variable = self.solver_variables[name]
+        matrix = sparse.csr_matrix(
+            (var_data[used], (var_rows[used], var_cols[used])),
+            shape=(len(sense_constraints), current_variable.size))
+        rhs += matrix @ current_variable
+      if sense == 0:
+        self.constraints += [rhs == 0]
+      if sense == 1:
+        self.constraints += [rhs <= 0]
+      if sense == -1:
+        self.constraints += [rhs >= 0]
+
   def create_activation_solver_constraint(
       self, constraint: relaxation.RelaxActivationConstraint, act_index: int,
       slope: float, bias: float):
@@ -109,6 +195,31 @@ class CvxpySolver(relaxation.RelaxationSolver):
     if constraint.sense == -1:
       self.constraints += [expression >= 0]
 
+  def create_activation_solver_constraints_batch(
+      self, constraint: relaxation.RelaxActivationConstraint,
+      act_indices: np.ndarray, slopes: np.ndarray, biases: np.ndarray):
+    """Create the linear constraints for several activations at once.
+
+    Args:
+      constraint: Constraint generated by the relaxation bound propagation.
+      act_indices: Indices of the activations to encode (in the variables
+        involved in constraint).
+      slopes: Slope coefficients of the linear inequalities.
+      biases: Biases of the linear inequalities.
+    """
+    if not act_indices.size:
+      return
+    outvar = self.solver_variables[constraint.outvar.name]
+    invar = self.solver_variables[constraint.invar.name]
+    expression = (cp.multiply(invar[act_indices], slopes) + biases
+                  - outvar[act_indices])
+    if constraint.sense == 0:
+      self.constraints += [expression == 0]
+    if constraint.sense == 1:
+      self.constraints += [expression <= 0]
+    if constraint.sense == -1:
+      self.constraints += [expression >= 0]
+
   def minimize_objective(
       self,
       var_name: str,
@@ -133,14 +244,19 @@ class CvxpySolver(relaxation.RelaxationSolver):
     if time_limit is not None:
       raise ValueError('Cvxpy Solver does not support time limit.')
     # Define the objective function
+    # Transfer the objective to the host once, rather than per coefficient.
+    objective = np.asarray(objective)
+    used = np.flatnonzero(np.abs(objective) > _EPS)
     obj = cp.expressions.constants.Constant(0.)
-    for i, coeff in enumerate(objective):
-      if np.abs(coeff) > _EPS:
-        obj += self.solver_variables[var_name][i] * coeff.item()
+    if used.size:
+      obj += objective[used] @ self.solver_variables[var_name][used]
     objective = cp.Minimize(obj)
     prob = cp.Problem(objective, self.constraints)
     logging.info('Starting problem solve.')
-    prob.solve(solver=cp.ECOS, **self.problem_kwargs)
+    # The problem is only solved once, so the parameters holding the variable
+    # bounds are treated as constants rather than going through the more
+    # expensive parametrized canonicalization.
+    prob.solve(**{'solver': cp.ECOS, 'ignore_dpp': True, **self.problem_kwargs})
     logging.info('Problem status is %s', prob.status)
     val = obj.value
     if val is not None:
@@ -150,6 +266,56 @@ class CvxpySolver(relaxation.RelaxationSolver):
     return val, solution, prob.status in (cp.settings.OPTIMAL,
                                           cp.settings.OPTIMAL_INACCURATE)
 
+  def minimize_objectives(
+      self,
+      var_name: str,
+      objectives: Tensor,
+      objective_biases: Union[float, Tensor],
+      time_limit: Optional[int] = None,
+  ) -> Tuple[Tensor, Tensor]:
+    """Minimize several linear functions over the same variable.
+
+    The problem is only built once, with a parametrized objective, so that
+    CVXPY does not need to canonicalize it again for each objective. It is
+    kept for subsequent calls, as long as no constraint has been added.
+
+    Args:
+      var_name: Index of the variable to define the linear functions over the
+        components.
+      objectives: Coefficients of the linear functions, one per row.
+      objective_biases: Biases of the linear functions, either one per row or
+        a single one shared by all of them.
+      time_limit: Maximum solve time in ms. Use None for unbounded. CVXPY does
+        not support time_limit so any other value will raise a ValueError.
+    Returns:
+      vals: Value of the minimum, for each objective.
+      statuses: Status of the optimization function, for each objective.
+    """
+    if time_limit is not None:
+      raise ValueError('Cvxpy Solver does not support time limit.')
+    objective_biases = np.broadcast_to(objective_biases, objectives.shape[:1])
+    nb_constraints, coeffs, prob = self._problems.get(var_name, (0, None, None))
+    if prob is None or nb_constraints != len(self.constraints):
+      coeffs = cp.Parameter(self.solver_variables[var_name].shape)
+      prob = cp.Problem(
+          cp.Minimize(coeffs @ self.solver_variables[var_name]),
+          self.constraints)
+      self._problems[var_name] = (len(self.constraints), coeffs, prob)
+    obj = prob.objective.args[0]
+    vals = np.full(objectives.shape[:1], np.nan)
+    statuses = np.zeros(objectives.shape[:1], dtype=bool)
+    for i, (objective, objective_bias) in enumerate(
+        zip(objectives, objective_biases)):
+      coeffs.value = np.asarray(objective, dtype=np.float64)
+      logging.info('Starting problem solve.')
+      prob.solve(**{'solver': cp.ECOS, **self.problem_kwargs})
+      logging.info('Problem status is %s', prob.status)
+      if obj.value is not None:
+        vals[i] = obj.value + objective_bias
+      statuses[i] = prob.status in (cp.settings.OPTIMAL,
+                                    cp.settings.OPTIMAL_INACCURATE)
+    return vals, statuses
+
 
 class CvxpyMIPSolver(CvxpySolver, relaxation.MIPSolver):
   """Holder class to represent problem being built."""
@@ -19,7 +19,10 @@ This is accomplished by traversing the JaxPR representation of the computation
 and translating the computational graph.
 """
 import abc
-import functools
+import collections
+from concurrent import futures
+import itertools
+import multiprocessing
 from typing import Callable, Tuple, Dict, Union, List, Optional
 
 import jax
@@ -86,6 +89,11 @@ class OptRelaxVariable(RelaxVariable):
       self._opted_bounds = self._optimize_transform.tight_bounds(self)
     return self._opted_bounds
 
+  @property
+  def optimized(self) -> bool:
+    """Whether the tightened bounds have already been computed."""
+    return self._opted_bounds is not None
+
 
 class BinaryVariable():
   """Binary variable."""
@@ -96,11 +104,32 @@ class BinaryVariable():
     self.idx = idx
 
 
+def _sample_values(values, index: int, shape) -> np.ndarray:
+  """Flattened values for the minibatch sample `index`.
+
+  Args:
+    values: Either a batched array of values, or a scalar shared by all the
+      activations of all the samples.
+    index: Index in the batch for which to get the values.
+    shape: Shape of the values for a single sample.
+  Returns:
+    values: Flat array of the values for the sample `index`.
+  """
+  values = np.asarray(values)
+  if values.ndim:
+    values = values[index, ...]
+  return np.reshape(np.broadcast_to(values, shape), [-1])
+
+
 class MIPActivationConstraint:
   """MIP constraint to encode activation."""
 
   def __init__(self, outvar, invar, binvar, mask, binscale, scale, bias, sense):
-    """Represents: outvar =(>)(<) scale * invar + binscale * binvar + bias."""
+    """Represents: outvar =(>)(<) scale * invar + binscale * binvar + bias.
+
+    `mask`, `binscale`, `scale` and `bias` can either be batched arrays, or
+    scalars shared by all the activations.
+    """
     self.outvar = outvar
     self.invar = invar
     self.binvar = binvar
@@ -117,23 +146,35 @@ class MIPActivationConstraint:
       solver: MIPSolver to create the exact constraint into.
       index: Index in the batch for which to build the variable.
     """
-    biases = np.reshape(self.bias[index, ...], [-1])
-    slopes = np.reshape(self.scale[index, ...], [-1])
-    binslopes = np.reshape(self.binscale[index, ...], [-1])
-    mask = np.reshape(self.mask[index, ...], [-1])
-    for act_index, (binslope, slope, bias) in enumerate(
-        zip(binslopes, slopes, biases)):
-      if mask[act_index]:
-        solver.create_mip_activation_solver_constraint(
-            self, act_index, binslope=binslope.item(),
-            slope=slope.item(), bias=bias.item())
+    shape = self.invar.shape[1:]
+    biases = _sample_values(self.bias, index, shape)
+    slopes = _sample_values(self.scale, index, shape)
+    binslopes = _sample_values(self.binscale, index, shape)
+    mask = _sample_values(self.mask, index, shape)
+    for act_index in np.flatnonzero(mask):
+      solver.create_mip_activation_solver_constraint(
+          self, int(act_index), binslope=float(binslopes[act_index]),
+          slope=float(slopes[act_index]), bias=float(biases[act_index]))
 
 
 class LinearConstraint:
-  """Linear constraint, to be encoded into a solver."""
+  """Linear constraint, to be encoded into a solver.
+
+  The coefficients are stored as flat arrays: `components` and the
+  coefficients concatenate those of all the variables involved, with the ones
+  of `variables[i]` being located between `offsets[i]` and `offsets[i+1]`.
+  The coefficients of affine layers are the same for all the samples of the
+  batch (as checked by `_get_linear`), only their bias can vary across it.
+  """
 
   def __init__(self, vars_and_coeffs, bias, sense):
-    self._vars_and_coeffs = vars_and_coeffs
+    self.variables = [var for var, _ in vars_and_coeffs]
+    self.components = np.concatenate(
+        [np.asarray(cpts, dtype=np.int64) for _, (cpts, _) in vars_and_coeffs])
+    self.offsets = np.cumsum(
+        [0] + [len(cpts) for _, (cpts, _) in vars_and_coeffs])
+    self._coeffs = np.concatenate(
+        [np.asarray(coeffs) for _, (_, coeffs) in vars_and_coeffs])
     self._bias = bias
     self.sense = sense
     self.sample_dependent = bool(self._bias.shape)
@@ -151,11 +192,25 @@ class LinearConstraint:
     """
     return self._bias[index] if self.sample_dependent else self._bias
 
+  def coeffs(self, index: int) -> np.ndarray:
+    """Get the flat coefficients corresponding to the sample `index`.
+
+    The coefficients are the same for all samples, and are returned without
+    copy.
+
+    Args:
+      index: Index in the batch for which to build the variable.
+    Returns:
+      coeffs: Coefficients of all the variables, aligned with `components`.
+    """
+    del index
+    return self._coeffs
+
   def vars_and_coeffs(self, index: int):
     """Get the variable and coefficients corresponding to the sample `index`.
 
-    If coeffs has a dimension, the coefficients are sample dependent. Otherwise,
-    the coefficients are the same for all samples.
+    Only the bias can be sample dependent, the coefficients are the same for
+    all samples and are returned without copy.
 
     Args:
       index: Index in the batch for which to build the variable.
@@ -163,11 +218,10 @@ class LinearConstraint:
       vars_and_coeffs: vars_and_coeffs list where the coefficients are the one
         corresponding to the sample `index`
     """
-    if self.sample_dependent:
-      return [(var, (cpts, coeffs[index]))
-              for (var, (cpts, coeffs)) in self._vars_and_coeffs]
-    else:
-      return self._vars_and_coeffs
+    coeffs = self.coeffs(index)
+    return [(var, (self.components[start:end], coeffs[start:end]))
+            for var, start, end in zip(
+                self.variables, self.offsets[:-1], self.offsets[1:])]
 
   def encode_into_solver(self, solver: 'RelaxationSolver', index: int):
     """Encode the linear constraints into the provided solver.
@@ -183,7 +237,11 @@ class RelaxActivationConstraint:
   """Linear constraint involved in the relaxation of an activation."""
 
   def __init__(self, outvar, invar, mask, scale, bias, sense):
-    """Represents the constraint outvar =(>)(<) scale * invar + bias."""
+    """Represents the constraint outvar =(>)(<) scale * invar + bias.
+
+    `mask`, `scale` and `bias` can either be batched arrays, or scalars shared
+    by all the activations.
+    """
     self.outvar = outvar
     self.invar = invar
     self.mask = mask
@@ -198,13 +256,15 @@ class RelaxActivationConstraint:
       solver: RelaxationSolver to create the linear constraint into.
       index: Index in the batch for which to build the variable.
     """
-    biases = np.reshape(self.bias[index, ...], [-1])
-    slopes = np.reshape(self.scale[index, ...], [-1])
-    mask = np.reshape(self.mask[index, ...], [-1])
-    for act_index, (slope, bias) in enumerate(zip(slopes, biases)):
-      if mask[act_index]:
-        solver.create_activation_solver_constraint(
-            self, act_index, slope.item(), bias.item())
+    shape = self.invar.shape[1:]
+    biases = _sample_values(self.bias, index, shape)
+    slopes = _sample_values(self.scale, index, shape)
+    mask = _sample_values(self.mask, index, shape)
+    act_indices = np.flatnonzero(mask)
+    solver.create_activation_solver_constraints_batch(
+        self, act_indices,
+        np.ascontiguousarray(slopes[act_indices], dtype=np.float64),
+        np.ascontiguousarray(biases[act_indices], dtype=np.float64))
 
 
 class RelaxationSolver(metaclass=abc.ABCMeta):
@@ -223,6 +283,22 @@ class RelaxationSolver(metaclass=abc.ABCMeta):
     if not self._variable_already_created(var):
       self._create_solver_relax_variable(var, index)
 
+  def maybe_create_solver_variables(
+      self,
+      variables: List[RelaxVariable],
+      index: int):
+    """Create solver variables for all the variables not created yet.
+
+    The default implementation creates them one at a time. Solvers able to add
+    several variables at once can override it.
+
+    Args:
+      variables: Variables generated by the relaxation bound propagation.
+      index: Index in the batch for which to build the variables.
+    """
+    for var in variables:
+      self.maybe_create_solver_variable(var, index)
+
   @abc.abstractmethod
   def _create_solver_relax_variable(
       self,
@@ -246,6 +322,24 @@ class RelaxationSolver(metaclass=abc.ABCMeta):
       var: Variable generated by the relaxation bound propagation.
     """
 
+  def update_variable_bounds(
+      self,
+      var_name: str,
+      lower: np.ndarray,
+      upper: np.ndarray):
+    """Update the bounds of an already created variable.
+
+    This allows bounds obtained by optimization to be added to the problem
+    without having to rebuild it. The default implementation does not modify
+    the problem, which is valid because the bounds obtained by optimization
+    are implied by the constraints already encoded.
+
+    Args:
+      var_name: Name of the variable to update.
+      lower: New lower bounds on the (flattened) variable.
+      upper: New upper bounds on the (flattened) variable.
+    """
+
   @abc.abstractmethod
   def create_linear_solver_constraint(
       self,
@@ -258,6 +352,22 @@ class RelaxationSolver(metaclass=abc.ABCMeta):
       index: Index in the batch for which to build the variable.
     """
 
+  def create_linear_solver_constraints_batch(
+      self,
+      constraints: List[LinearConstraint],
+      index: int):
+    """Create several solver linear constraints at once.
+
+    The default implementation creates them one at a time. Solvers able to add
+    a sparse matrix of constraints at once should override it.
+
+    Args:
+      constraints: Constraints generated by the relaxation bound propagation.
+      index: Index in the batch for which to build the variable.
+    """
+    for constraint in constraints:
+      self.create_linear_solver_constraint(constraint, index)
+
   @abc.abstractmethod
   def create_activation_solver_constraint(
       self,
@@ -275,6 +385,28 @@ class RelaxationSolver(metaclass=abc.ABCMeta):
       bias: Bias of the linear inequality
     """
 
+  def create_activation_solver_constraints_batch(
+      self,
+      constraint: RelaxActivationConstraint,
+      act_indices: np.ndarray,
+      slopes: np.ndarray,
+      biases: np.ndarray):
+    """Create the linear constraints for several activations at once.
+
+    The default implementation creates the constraints one at a time. Solvers
+    supporting vectorized constraint creation should override it.
+
+    Args:
+      constraint: Constraint generated by the relaxation bound propagation.
+      act_indices: Indices of the activations to encode (in the variables
+        involved in constraint).
+      slopes: Slope coefficients of the linear inequalities.
+      biases: Biases of the linear inequalities.
+    """
+    for act_index, slope, bias in zip(act_indices, slopes, biases):
+      self.create_activation_solver_constraint(
+          constraint, int(act_index), float(slope), float(bias))
+
   @abc.abstractmethod
   def minimize_objective(
       self,
@@ -297,6 +429,42 @@ class RelaxationSolver(metaclass=abc.ABCMeta):
       status: Status of the optimization function.
     """
 
+  def minimize_objectives(
+      self,
+      var_name: str,
+      objectives: np.ndarray,
+      objective_biases: Union[float, np.ndarray],
+      time_limit_millis: Optional[int],
+  ) -> Tuple[np.ndarray, np.ndarray]:
+    """Minimize several linear functions over the same variable.
+
+    The default implementation solves each problem with `minimize_objective`.
+    Solvers that can re-optimize after only changing the objective (for
+    example by warm-starting from the previous solution) should override it.
+
+    Args:
+      var_name: Index of the variable to define the linear functions over the
+        components.
+      objectives: Coefficients of the linear functions, one per row.
+      objective_biases: Biases of the linear functions, either one per row or
+        a single one shared by all of them.
+      time_limit_millis: Maximum solve time in ms, for each of the problems.
+        Use None for unbounded.
+    Returns:
+      vals: Value of the minimum, for each objective.
+      statuses: Status of the optimization function, for each objective.
+    """
+    objective_biases = np.broadcast_to(objective_biases, objectives.shape[:1])
+    vals = np.full(objectives.shape[:1], np.nan)
+    statuses = np.zeros(objectives.shape[:1], dtype=bool)
+    for i, (objective, objective_bias) in enumerate(
+        zip(objectives, objective_biases)):
+      val, _, statuses[i] = self.minimize_objective(
+          var_name, objective, float(objective_bias), time_limit_millis)
+      if val is not None:
+        vals[i] = val
+    return vals, statuses
+
 
 class MIPSolver(RelaxationSolver):
   """Abstract solver for the MIP encoding."""
@@ -349,6 +517,33 @@ class MIPSolver(RelaxationSolver):
     """
 
 
+def _encode_constraints(
+    solver: RelaxationSolver,
+    constraints: List[Union[LinearConstraint, RelaxActivationConstraint,
+                            MIPActivationConstraint]],
+    index: int):
+  """Encodes constraints into the solver, batching all the linear ones.
+
+  Args:
+    solver: Solver in which the variables involved have been created.
+    constraints: Constraints generated by the relaxation bound propagation.
+    index: The index in the minibatch for which the constraints should be
+      encoded.
+  """
+  linear_constraints = []
+  for constraint in constraints:
+    if isinstance(constraint, LinearConstraint):
+      linear_constraints.append(constraint)
+      continue
+    if isinstance(constraint, MIPActivationConstraint):
+      # create manually the binary variable because it is not collected
+      # automatically by the graph propagation.
+      solver.maybe_create_solver_variable(constraint.binvar, index)
+    constraint.encode_into_solver(solver, index)
+  if linear_constraints:
+    solver.create_linear_solver_constraints_batch(linear_constraints, index)
+
+
 def encode_relaxation(
     solver_ctor: Callable[[], RelaxationSolver],
     env: Dict[jax.core.Var, Union[RelaxVariable, Tensor]],
@@ -365,19 +560,15 @@ def encode_relaxation(
     solver: Solver containing the relaxation of the network encoded.
   """
   solver = solver_ctor()
-  for key in env.keys():
-    if isinstance(env[key], RelaxVariable):
-      variable = env[key]
-      # Create the variable in the solver.
-      solver.maybe_create_solver_variable(variable, index)
-      # Create the constraints in the solver.
-      if variable.constraints:
-        for constraint in variable.constraints:
-          if isinstance(constraint, MIPActivationConstraint):
-            # create manually the binary variable because it is not collected
-            # automatically by the graph propagation.
-            solver.maybe_create_solver_variable(constraint.binvar, index)
-          constraint.encode_into_solver(solver, index)
+  variables = [var for var in env.values() if isinstance(var, RelaxVariable)]
+  # Create all the variables in the solver, and then all the constraints, so
+  # that both can be done in bulk.
+  solver.maybe_create_solver_variables(variables, index)
+  constraints = []
+  for var in variables:
+    if var.constraints:
+      constraints.extend(var.constraints)
+  _encode_constraints(solver, constraints, index)
   return solver
 
 
@@ -412,6 +603,181 @@ def solve_relaxation(
                                    objective, objective_bias, time_limit_millis)
 
 
+def _expand_to_axes(x, axes, ndim):
+  """Reshapes `x` so that its successive dimensions lie along `axes`."""
+  shape = [1] * ndim
+  for axis, size in zip(axes, np.shape(x)):
+    shape[axis] = size
+  return np.reshape(x, shape)
+
+
+def _split_coefficients(rows, cols, vals, nb_rows):
+  """Groups sparse coefficients according to the output component (row)."""
+  order = np.argsort(rows, kind='stable')
+  rows, cols, vals = rows[order], cols[order], vals[order]
+  splits = np.cumsum(np.bincount(rows, minlength=nb_rows))[:-1]
+  return np.split(cols, splits), np.split(vals, splits)
+
+
+def _conv_linear(outval, lhs, rhs, **params):
+  """Get linear expressions for a convolution directly from its kernel.
+
+  The jacobian of a convolution is mostly zeros, so rather than materializing
+  it, the input components on which each output depends are derived from the
+  convolution parameters.
+
+  Args:
+    outval: dummy tensor shaped according to a single example's outputs
+    lhs: Input of the convolution.
+    rhs: Kernel of the convolution.
+    **params: Keyword Arguments of the primitive.
+
+  Returns:
+    `coefficients` as returned by `_get_linear`, or None if this is not a
+    convolution of a variable input by a constant kernel.
+  """
+  if (not isinstance(lhs, RelaxVariable) or isinstance(rhs, RelaxVariable)
+      or params['feature_group_count'] != 1
+      or params['batch_group_count'] != 1):
+    return None
+  lhs_spec, rhs_spec, out_spec = params['dimension_numbers']
+  out_shape = (1,) + outval.shape
+  # Kernel with layout (out features, in features, *spatial).
+  kernel = np.transpose(np.asarray(rhs), rhs_spec)
+  nb_out_feats, nb_in_feats = kernel.shape[:2]
+  kernel_sizes = kernel.shape[2:]
+  nb_spatial = len(kernel_sizes)
+  out_sizes = [out_shape[dim] for dim in out_spec[2:]]
+  in_sizes = [lhs.shape[dim] for dim in lhs_spec[2:]]
+
+  # Coefficients are enumerated along the axes
+  # (*out_spatial, out_feature, *kernel_spatial, in_feature).
+  ndim = 2 * nb_spatial + 2
+  out_feat_axis = nb_spatial
+  in_feat_axis = ndim - 1
+  out_coords = [None] * len(out_shape)
+  in_coords = [None] * len(lhs.shape)
+  out_coords[out_spec[0]] = in_coords[lhs_spec[0]] = 0
+  out_coords[out_spec[1]] = _expand_to_axes(
+      np.arange(nb_out_feats), [out_feat_axis], ndim)
+  in_coords[lhs_spec[1]] = _expand_to_axes(
+      np.arange(nb_in_feats), [in_feat_axis], ndim)
+  valid = np.ones([1] * ndim, dtype=bool)
+  for i in range(nb_spatial):
+    out_axis = i
+    kernel_axis = out_feat_axis + 1 + i
+    out_coords[out_spec[2 + i]] = _expand_to_axes(
+        np.arange(out_sizes[i]), [out_axis], ndim)
+    # Position in the padded and dilated input of each kernel element.
+    pos = (np.arange(out_sizes[i])[:, None] * params['window_strides'][i]
+           - params['padding'][i][0]
+           + np.arange(kernel_sizes[i])[None, :] * params['rhs_dilation'][i])
+    lhs_dilation = params['lhs_dilation'][i]
+    in_pos = pos // lhs_dilation
+    valid = valid & _expand_to_axes(
+        (pos >= 0) & (pos % lhs_dilation == 0) & (in_pos < in_sizes[i]),
+        [out_axis, kernel_axis], ndim)
+    in_coords[lhs_spec[2 + i]] = _expand_to_axes(
+        in_pos, [out_axis, kernel_axis], ndim)
+  weights = _expand_to_axes(
+      np.moveaxis(kernel, 1, -1), range(out_feat_axis, ndim), ndim)
+
+  full_shape = np.broadcast(valid, weights, *out_coords, *in_coords).shape
+  keep = np.broadcast_to(valid & (weights != 0), full_shape)
+  rows = np.ravel_multi_index(
+      [np.broadcast_to(coord, full_shape)[keep] for coord in out_coords],
+      out_shape)
+  # Invalid positions are masked out, clip them to be able to ravel.
+  cols = np.ravel_multi_index(
+      [np.broadcast_to(coord, full_shape)[keep] for coord in in_coords],
+      lhs.shape, mode='clip')
+  vals = np.broadcast_to(weights, full_shape)[keep]
+  return [_split_coefficients(rows, cols, vals, outval.size), None]
+
+
+def _dot_linear(outval, lhs, rhs, **params):
+  """Get linear expressions for a dot product directly from its weights.
+
+  Args:
+    outval: dummy tensor shaped according to a single example's outputs
+    lhs: Variable operand of the dot product.
+    rhs: Constant operand of the dot product.
+    **params: Keyword Arguments of the primitive.
+
+  Returns:
+    `coefficients` as returned by `_get_linear`, or None if this is not a
+    product of a variable by constant weights without batch dimensions.
+  """
+  (lhs_contract, rhs_contract), (lhs_batch, _) = params['dimension_numbers']
+  if (not isinstance(lhs, RelaxVariable) or isinstance(rhs, RelaxVariable)
+      or lhs_batch or 0 in lhs_contract):
+    return None
+  rhs = np.asarray(rhs)
+  lhs_free = [dim for dim in range(1, len(lhs.shape))
+              if dim not in lhs_contract]
+  rhs_free = [dim for dim in range(rhs.ndim) if dim not in rhs_contract]
+  # Coefficients are enumerated along the axes
+  # (*lhs_free, *rhs_free, *contracting).
+  sizes = ([lhs.shape[dim] for dim in lhs_free]
+           + [rhs.shape[dim] for dim in rhs_free]
+           + [lhs.shape[dim] for dim in lhs_contract])
+  grid = np.meshgrid(*[np.arange(size) for size in sizes], indexing='ij')
+  nb_out_dims = len(lhs_free) + len(rhs_free)
+  in_coords = [np.zeros_like(grid[0])] * len(lhs.shape)
+  for dim, coord in zip(list(lhs_free) + list(lhs_contract),
+                        grid[:len(lhs_free)] + grid[nb_out_dims:]):
+    in_coords[dim] = coord
+  weights = np.broadcast_to(
+      np.transpose(rhs, list(rhs_free) + list(rhs_contract)), grid[0].shape)
+  keep = weights != 0
+  rows = np.ravel_multi_index([coord[keep] for coord in grid[:nb_out_dims]],
+                              outval.shape)
+  cols = np.ravel_multi_index([coord[keep] for coord in in_coords], lhs.shape)
+  vals = weights[keep]
+  return [_split_coefficients(rows, cols, vals, outval.size), None]
+
+
+def _elementwise_linear(outval, signs, *args):
+  """Get linear expressions for a sum of variables and constants.
+
+  Args:
+    outval: dummy tensor shaped according to a single example's outputs
+    signs: Sign applied to each of the arguments.
+    *args: Arguments of the sum.
+
+  Returns:
+    `coefficients` as returned by `_get_linear`, or None if one of the variables
+    is broadcast.
+  """
+  if any(isinstance(arg, RelaxVariable) and arg.shape[1:] != outval.shape
+         for arg in args):
+    return None
+  components = list(np.arange(outval.size)[:, None])
+  coefficients = []
+  for arg, sign in zip(args, signs):
+    if isinstance(arg, RelaxVariable):
+      coefficients.append(
+          (components, list(np.full((outval.size, 1), sign, np.float32))))
+    else:
+      coefficients.append(None)
+  return coefficients
+
+
+def _add_linear(outval, lhs, rhs):
+  """Get linear expressions for an addition, see `_elementwise_linear`."""
+  return _elementwise_linear(outval, (1., 1.), lhs, rhs)
+
+
+def _sub_linear(outval, lhs, rhs):
+  """Get linear expressions for a subtraction, see `_elementwise_linear`."""
+  return _elementwise_linear(outval, (1., -1.), lhs, rhs)
+
+
+# Number of rows (or columns) of the jacobian of an affine layer materialized at
+# once, when it can not be derived from the structure of the layer.
+_JACOBIAN_BLOCK_SIZE = 256
+
+
 def _get_linear(primitive, outval, *eqn_invars, **params):
   """Get linear expressions corresponding to an affine layer.
 
@@ -422,41 +788,222 @@ def _get_linear(primitive, outval, *eqn_invars, **params):
     **params: Keyword Arguments of the primitive.
 
   Returns:
-    For each output component, a pair `(bias, coefficients)`, where
-    `coefficients` is a list of `(component, coefficient)` pairs.
+    biases: Array containing the bias of each output component. If the bias
+      differs between the samples of the batch, because one of the constant
+      arguments has a batch dimension, this has an additional trailing
+      dimension, indexed by sample.
+    coefficients: List with one entry per argument of the primitive. This is
+      None for the non-variable arguments, and otherwise a pair of lists
+      `(components, coeffs)`, containing for each output component the array
+      of the input components it depends on and the array of the
+      corresponding coefficients.
   """
-  def funx(x):
-    if isinstance(x, RelaxVariable):
-      return jnp.zeros(x.shape)
+  var_positions = [i for i, x in enumerate(eqn_invars)
+                   if isinstance(x, RelaxVariable)]
+  def batch_fun(*var_args):
+    args = list(eqn_invars)
+    for pos, var_arg in zip(var_positions, var_args):
+      args[pos] = var_arg
+    return primitive.bind(*args, **params)
+  zero_vars = [jnp.zeros(eqn_invars[pos].shape) for pos in var_positions]
+  batch_size = zero_vars[0].shape[0]
+
+  # The coefficients are only derived from the first sample of the batch. This
+  # is only valid if they are the same for all samples, which might not be the
+  # case if one of the constant arguments has a batch dimension. Check it by
+  # comparing the derivatives of all samples along a shared random direction,
+  # up to rounding errors relative to their magnitude.
+  if batch_size > 1 and any(
+      np.ndim(x) and np.shape(x)[0] == batch_size
+      for i, x in enumerate(eqn_invars) if i not in var_positions):
+    rng = np.random.RandomState(0)
+    directions = [
+        jnp.broadcast_to(rng.randn(*x.shape[1:]).astype(x.dtype), x.shape)
+        for x in zero_vars]
+    batch_out, batch_tangents = jax.jvp(batch_fun, zero_vars, directions)
+    batch_tangents = np.reshape(np.asarray(batch_tangents), [batch_size, -1])
+    tolerance = 1e-5 * np.abs(batch_tangents).max()
+    if np.any(np.abs(batch_tangents - batch_tangents[0]) > tolerance):
+      raise NotImplementedError(
+          f'Coefficients of {primitive} differ between samples of the batch')
+  else:
+    batch_out = batch_fun(*zero_vars)
+
+  # The constant arguments may however only lead to a different bias for each
+  # sample, so evaluate the biases of all the samples at once.
+  batch_biases = np.reshape(np.asarray(batch_out), [batch_out.shape[0], -1])
+  if np.all(batch_biases == batch_biases[0]):
+    biases = batch_biases[0]
+  else:
+    biases = batch_biases.T
+
+  if primitive in _linear_handlers:
+    # Use structured coefficients when available, which avoids materializing
+    # the jacobian of the primitive.
+    coefficients = _linear_handlers[primitive](outval, *eqn_invars, **params)
+    if coefficients is not None:
+      return biases, coefficients
+
+  def fun(*var_args):
+    args = list(eqn_invars)
+    for pos, var_arg in zip(var_positions, var_args):
+      # Only the first example of the batch is used to obtain the output, so
+      # we differentiate with regards to a single example's inputs, broadcast
+      # over the batch dimension.
+      args[pos] = jnp.broadcast_to(var_arg, eqn_invars[pos].shape)
+    return jnp.reshape(primitive.bind(*args, **params)[0, ...], [-1])
+  zeros = [jnp.zeros(eqn_invars[pos].shape[1:]) for pos in var_positions]
+
+  # Flatten and concatenate all the variables, so that the jacobian with
+  # regards to all of them is obtained at once.
+  in_offsets = np.cumsum([0] + [x.size for x in zeros])
+  in_size = int(in_offsets[-1])
+  def flat_fun(flat_in):
+    return fun(*[jnp.reshape(flat_in[start:end], x.shape)
+                 for x, start, end in zip(zeros, in_offsets[:-1],
+                                          in_offsets[1:])])
+  flat_zeros = jnp.zeros(in_size)
+
+  # Use the mode requiring the fewest evaluations.
+  if outval.size <= in_size:
+    # The primitive is affine, so the rows of the jacobian are directly given
+    # by applying its transpose to each of the output directions.
+    transpose_fun = jax.linear_transpose(flat_fun, flat_zeros)
+    block_fun = jax.vmap(lambda direction: transpose_fun(direction)[0])
+    nb_directions = outval.size
+  else:
+    # The columns of the jacobian are given by its product with each of the
+    # input directions.
+    block_fun = jax.vmap(
+        lambda direction: jax.jvp(flat_fun, (flat_zeros,), (direction,))[1])
+    nb_directions = in_size
+
+  # Loop over blocks of directions to avoid creating a large materialized
+  # tensor, and only keep the nonzero coefficients of each block.
+  rows = [np.zeros(0, dtype=np.int64)]
+  cols = [np.zeros(0, dtype=np.int64)]
+  vals = [np.zeros(0, dtype=np.float32)]
+  for start in range(0, nb_directions, _JACOBIAN_BLOCK_SIZE):
+    block_size = min(_JACOBIAN_BLOCK_SIZE, nb_directions - start)
+    block = np.asarray(
+        block_fun(jnp.eye(block_size, nb_directions, k=start)))
+    block_dirs, block_others = np.nonzero(block)
+    vals.append(block[block_dirs, block_others])
+    if outval.size <= in_size:
+      rows.append(block_dirs + start)
+      cols.append(block_others)
     else:
-      return x
-  def fungrad(i, args):
-    return jnp.reshape(primitive.bind(*args, **params)[0, ...], [-1])[i]
-  results = []
-  # Loop over output dimensions one at a time to avoid creating a large
-  # materialized tensor
-  # TODO: Replace with something more efficient
-  for i in range(outval.size):
-    fung = functools.partial(fungrad, i)
-    bias, current_grad = jax.value_and_grad(fung)(
-        [funx(x) for x in eqn_invars])
-    coefficients = []
-    for res in current_grad:
-      components = jnp.flatnonzero(res)
-      coefficients.append((components, res.ravel()[components]))
-    results.append((bias, coefficients))
-  return results
+      rows.append(block_others)
+      cols.append(block_dirs + start)
+  rows, cols, vals = (np.concatenate(x) for x in (rows, cols, vals))
+
+  coefficients = [None] * len(eqn_invars)
+  for pos, start, end in zip(var_positions, in_offsets[:-1], in_offsets[1:]):
+    # Split the coefficients according to the variable and the output
+    # component they correspond to.
+    in_var = (cols >= start) & (cols < end)
+    coefficients[pos] = _split_coefficients(
+        rows[in_var], cols[in_var] - start, vals[in_var], outval.size)
+  return biases, coefficients
+
+
+_linear_handlers = {
+    lax.add_p: _add_linear,
+    lax.conv_general_dilated_p: _conv_linear,
+    lax.dot_general_p: _dot_linear,
+    lax.sub_p: _sub_linear,
+}
 
+# Number of affine layers whose linear expressions are kept by each
+# `RelaxationTransform`.
+_LINEAR_CACHE_SIZE = 128
 
+
+def _params_key(params):
+  """Hashable key identifying the parameters of a primitive.
+
+  Synthetic primitives such as `linear_p` carry the subgraph they stand for as
+  a parameter. Each occurrence of the same layer gets its own subgraph, with
+  its own variables, so subgraphs are described by their structure instead.
+
+  Args:
+    params: Keyword Arguments of the primitive.
+  Returns:
+    key: Tuple describing the parameters, only hashable if they all are.
+  """
+  return tuple(sorted(
+      (name, _jaxpr_key(value) if isinstance(value, jax.core.Jaxpr) else value)
+      for name, value in params.items()))
+
+
+def _jaxpr_key(jaxpr):
+  """Key describing a jaxpr, independently of the naming of its variables."""
+  var_ids = {var: i for i, var in enumerate(jaxpr.invars)}
+  def atom_key(atom):
+    if isinstance(atom, jax.core.Literal):
+      val = np.asarray(atom.val)
+      return ('literal', val.dtype.str, val.shape, val.tobytes())
+    return var_ids.setdefault(atom, len(var_ids))
+  eqns_key = tuple(
+      (eqn.primitive, tuple(atom_key(x) for x in eqn.invars),
+       tuple(atom_key(x) for x in eqn.outvars), _params_key(eqn.params))
+      for eqn in jaxpr.eqns)
+  return eqns_key, tuple(atom_key(x) for x in jaxpr.outvars)
+
+
+def _get_linear_cached(cache, primitive, outval, *eqn_invars, **params):
+  """Get linear expressions corresponding to an affine layer, with caching.
+
+  The results of `_get_linear` only depend on the shapes of the variables and
+  on the values of the constant arguments, so they can be reused when the same
+  layer is applied several times. Constant arguments are identified by their
+  id, so they are kept alive by the cache entries, and numpy constants, which
+  could be modified in place, are not cached.
+
+  Args:
+    cache: OrderedDict in which to keep the linear expressions of the recently
+      encountered layers, or None to not use caching.
+    primitive: jax primitive
+    outval: dummy tensor shaped according to a single example's outputs
+    *eqn_invars: Arguments of the primitive, wrapped as RelaxVariables
+    **params: Keyword Arguments of the primitive.
+
+  Returns:
+    Same as `_get_linear`.
+  """
+  consts = [x for x in eqn_invars if not isinstance(x, RelaxVariable)]
+  if cache is None or any(isinstance(x, np.ndarray) for x in consts):
+    return _get_linear(primitive, outval, *eqn_invars, **params)
+  args_key = tuple(
+      ('var', x.shape) if isinstance(x, RelaxVariable) else ('const', id(x))
+      for x in eqn_invars)
+  key = (primitive, outval.shape, args_key, _params_key(params))
+  try:
+    hash(key)
+  except TypeError:
+    # Some parameters can not be hashed, don't use the cache.
+    return _get_linear(primitive, outval, *eqn_invars, **params)
+
+  if key in cache:
+    cache.move_to_end(key)
+    return cache[key][1]
+  linear = _get_linear(primitive, outval, *eqn_invars, **params)
+  cache[key] = (consts, linear)
+  if len(cache) > _LINEAR_CACHE_SIZE:
+    cache.popitem(last=False)
+  return linear
+
+
+@jax.jit
 def _get_relu_relax(lower, upper):
   """Upper chord of triangle relu relaxation."""
   on = lower >= 0.
-  amb = jnp.logical_and(lower < 0., upper > 0.)
-  slope = jnp.where(on, jnp.ones_like(lower), jnp.zeros_like(lower))
-  slope += jnp.where(amb, upper/jnp.maximum(upper-lower, 1e-12),
-                     jnp.zeros_like(lower))
-  bias = jnp.where(amb, -lower * upper/jnp.maximum(upper-lower, 1e-12),
-                   jnp.zeros_like(lower))
+  amb = (lower < 0.) & (upper > 0.)
+  upper_frac = upper / jnp.maximum(upper - lower, 1e-12)
+  ones = jnp.ones_like(lower)
+  zeros = jnp.zeros_like(lower)
+  slope = lax.select(on, ones, lax.select(amb, upper_frac, zeros))
+  bias = lax.select(amb, -lower * upper_frac, zeros)
   return slope, bias
 
 
@@ -488,7 +1035,8 @@ _activation_list = [synthetic_primitives.relu_p]
 def _relax_primitive(
     index: bound_propagation.Index, out_bounds: bound_propagation.Bound,
     primitive: jax.core.Primitive,
-    *args, use_mip: bool = False, **kwargs
+    *args, use_mip: bool = False, dtype=np.float32,
+    linear_cache: Optional[collections.OrderedDict] = None, **kwargs
     ) -> RelaxVariable:
   """Generates the relaxation for a given primitive op.
 
@@ -499,6 +1047,10 @@ def _relax_primitive(
     *args: Arguments of the primitive, wrapped as RelaxVariables
     use_mip: whether to use mixed integer programming for the activation
       constraints.
+    dtype: Floating point type in which to store the coefficients of the
+      constraints.
+    linear_cache: Cache of the linear expressions of affine layers, see
+      `_get_linear_cached`. None to not use caching.
     **kwargs: Keyword Arguments of the primitive.
   Returns:
     `RelaxVariable` that contains the output of this primitive for the
@@ -508,27 +1060,36 @@ def _relax_primitive(
   out_variable = RelaxVariable(index, out_bounds)
   # Create constraints linking output and input of primitive
   constraints = []
+  zero = np.array(0., dtype=dtype)
+  one = np.array(1., dtype=dtype)
   if primitive in _order_preserving_reshapes:
     invar = args[0]
     constraints = [RelaxActivationConstraint(outvar=out_variable,
                                              invar=invar,
-                                             mask=jnp.ones(invar.shape),
-                                             scale=jnp.ones(invar.shape),
-                                             bias=jnp.zeros(invar.shape),
+                                             mask=True,
+                                             scale=one,
+                                             bias=zero,
                                              sense=0)]
   elif primitive in _affine_primitives_list:
     if primitive == lax.div_p and isinstance(args[1], RelaxVariable):
       raise NotImplementedError(
           'Division with non-constant divisor is not supported')
-    results = _get_linear(primitive, out_bounds.lower[0, ...],
-                          *args, **kwargs)
-    for i, (bias, coeffs) in enumerate(results):
+    biases, coeffs = _get_linear_cached(linear_cache, primitive,
+                                        out_bounds.lower[0, ...],
+                                        *args, **kwargs)
+    biases = biases.astype(dtype, copy=False)
+    var_coeffs = []
+    for arg, coeff in zip(args, coeffs):
+      if isinstance(arg, RelaxVariable):
+        cpts, arg_coeffs = coeff
+        var_coeffs.append((arg, (cpts, [row_coeffs.astype(dtype, copy=False)
+                                        for row_coeffs in arg_coeffs])))
+    for i, bias in enumerate(biases):
       # Coefficients of the input variable(s).
-      vars_and_coeffs = [
-          (arg, coeff) for arg, coeff in zip(args, coeffs)
-          if isinstance(arg, RelaxVariable)]
+      vars_and_coeffs = [(arg, (cpts[i], arg_coeffs[i]))
+                         for arg, (cpts, arg_coeffs) in var_coeffs]
       # Equate with the output variable, by using a coefficient of -1.
-      out_coeff = (np.array([i], dtype=np.int64), np.array([-1.]))
+      out_coeff = (np.array([i], dtype=np.int64), np.array([-1.], dtype=dtype))
       vars_and_coeffs.append((out_variable, out_coeff))
       constraints.append(LinearConstraint(vars_and_coeffs, bias, 0))
   elif primitive in _activation_list:
@@ -544,29 +1105,29 @@ def _relax_primitive(
         RelaxActivationConstraint(outvar=out_variable,
                                   invar=invar,
                                   mask=relu_off,
-                                  scale=jnp.zeros_like(invar.lower),
-                                  bias=jnp.zeros_like(invar.lower),
+                                  scale=zero,
+                                  bias=zero,
                                   sense=0),
         # relu(x) = x if relu_on
         RelaxActivationConstraint(outvar=out_variable,
                                   invar=invar,
                                   mask=relu_on,
-                                  scale=jnp.ones_like(invar.lower),
-                                  bias=jnp.zeros_like(invar.lower),
+                                  scale=one,
+                                  bias=zero,
                                   sense=0),
         # relu(x) >= 0 if relu_ambiguous
         RelaxActivationConstraint(outvar=out_variable,
                                   invar=invar,
                                   mask=relu_ambiguous,
-                                  scale=jnp.zeros_like(invar.lower),
-                                  bias=jnp.zeros_like(invar.lower),
+                                  scale=zero,
+                                  bias=zero,
                                   sense=1),
         # relu(x) >= x if relu_ambiguous
         RelaxActivationConstraint(outvar=out_variable,
                                   invar=invar,
                                   mask=relu_ambiguous,
-                                  scale=jnp.ones_like(invar.lower),
-                                  bias=jnp.zeros_like(invar.lower),
+                                  scale=one,
+                                  bias=zero,
                                   sense=1),
         # upper chord of triangle relax if relu_ambiguous
         RelaxActivationConstraint(outvar=out_variable,
@@ -584,8 +1145,8 @@ def _relax_primitive(
                                   binvar=binvar,
                                   binscale=invar.upper,
                                   mask=relu_ambiguous,
-                                  scale=jnp.zeros_like(invar.lower),
-                                  bias=jnp.zeros_like(invar.lower),
+                                  scale=zero,
+                                  bias=zero,
                                   sense=-1),
           # outvar <= invar - lower_bound * (1. - binvar)
           MIPActivationConstraint(outvar=out_variable,
@@ -593,7 +1154,7 @@ def _relax_primitive(
                                   binvar=binvar,
                                   binscale=invar.lower,
                                   mask=relu_ambiguous,
-                                  scale=jnp.ones_like(invar.lower),
+                                  scale=one,
                                   bias=-invar.lower,
                                   sense=-1),
       ]
@@ -611,6 +1172,7 @@ class RelaxationTransform(bound_propagation.GraphTransform[RelaxVariable]):
       self,
       boundprop_transform: bound_propagation.BoundTransform,
       use_mip: bool = False,
+      dtype=np.float32,
       ):
     """Defines relaxation constraint propagation.
 
@@ -619,9 +1181,15 @@ class RelaxationTransform(bound_propagation.GraphTransform[RelaxVariable]):
         the underlying bound propagation method.
       use_mip: whether to use mixed integer programming for the activation
         constraints.
+      dtype: Floating point type in which to store the coefficients of the
+        constraints. Solvers receive them in their own precision, so this
+        only needs to be changed to keep more precise coefficients.
     """
     self._boundprop_transform = boundprop_transform
     self._use_mip = use_mip
+    self._dtype = dtype
+    # Linear expressions of the recently encountered affine layers.
+    self._linear_cache = collections.OrderedDict()
 
   def input_transform(self, context, lower_bound, upper_bound):
     in_bounds = self._boundprop_transform.input_transform(
@@ -635,7 +1203,62 @@ class RelaxationTransform(bound_propagation.GraphTransform[RelaxVariable]):
         context, primitive, *interval_args, **params)
     return _relax_primitive(
         context.index, out_bounds, primitive, *args,
-        use_mip=self._use_mip, **params)
+        use_mip=self._use_mip, dtype=self._dtype,
+        linear_cache=self._linear_cache, **params)
+
+
+def _cast_outwards(
+    lower: np.ndarray, upper: np.ndarray, dtype,
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Casts bounds to `dtype`, rounding them outwards so that they stay valid."""
+  cast_lower = lower.astype(dtype)
+  cast_upper = upper.astype(dtype)
+  neg_inf = cast_lower.dtype.type(-np.inf)
+  pos_inf = cast_upper.dtype.type(np.inf)
+  cast_lower = np.where(cast_lower > lower,
+                        np.nextafter(cast_lower, neg_inf), cast_lower)
+  cast_upper = np.where(cast_upper < upper,
+                        np.nextafter(cast_upper, pos_inf), cast_upper)
+  return cast_lower, cast_upper
+
+
+def _solve_sample_bounds(
+    solver: RelaxationSolver,
+    var_name: str,
+    nb_targets: int,
+    targets: Optional[np.ndarray],
+    time_limit_millis: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Computes the bounds on components of a variable for one sample.
+
+  This is defined at the module level so that it can be run in a worker
+  process.
+
+  Args:
+    solver: Solver in which the relaxation for the sample has been encoded.
+    var_name: Name of the variable to bound.
+    nb_targets: Number of components of the variable for one sample.
+    targets: Flat indices of the components to bound. None for all of them.
+    time_limit_millis: Time limit on solver. None if unbounded.
+  Returns:
+    lbs: Lower bounds on each of the components in `targets`.
+    ubs: Upper bounds on each of the components in `targets`.
+  """
+  # Minimize and maximize each of the components of the variable, in a
+  # single batch of problems sharing the same constraints. Only the rows of
+  # the identity corresponding to the targets are built.
+  if targets is None:
+    targets = np.arange(nb_targets)
+  nb_objectives = len(targets)
+  if not nb_objectives:
+    return np.empty(0), np.empty(0)
+  objectives = np.zeros((nb_objectives, nb_targets), dtype=np.float32)
+  objectives[np.arange(nb_objectives), targets] = 1.
+  objectives = np.concatenate([objectives, -objectives], axis=0)
+  vals, optimal = solver.minimize_objectives(
+      var_name, objectives, 0., time_limit_millis)
+  assert all(optimal)
+  return vals[:nb_objectives], -vals[nb_objectives:]
 
 
 class OptimizedRelaxationTransform(
@@ -646,43 +1269,133 @@ class OptimizedRelaxationTransform(
       self,
       transform: bound_propagation.GraphTransform[RelaxVariable],
       solver_ctor: Callable[[], RelaxationSolver],
-      time_limit_millis: Optional[int] = None):
+      time_limit_millis: Optional[int] = None,
+      num_workers: Optional[int] = None,
+      skip_stable_activation_inputs: bool = True):
+    """Defines optimized relaxation constraint propagation.
+
+    Args:
+      transform: Transform producing the RelaxVariables to optimize.
+      solver_ctor: Constructor for the solvers, one of which is created for
+        each sample of the minibatch.
+      time_limit_millis: Time limit on each solve. None if unbounded.
+      num_workers: If set, the problems for the different samples of the
+        minibatch are solved in parallel, in a pool of `num_workers` worker
+        processes. The solvers then need to be picklable, as each of them is
+        sent to a worker every time bounds are tightened. Any state built by
+        the workers, such as cached problems, is discarded afterwards. The
+        workers are started with `spawn`, as forking a process in which JAX is
+        running can deadlock, and `close` needs to be called to stop them,
+        or the transform used as a context manager.
+      skip_stable_activation_inputs: If True, the bounds on the inputs of the
+        activations are only optimized for the components whose sign is not
+        already known from the base bounds, as the relaxation of the
+        activation is exact for the others. Other users of the same variables
+        still get fully optimized bounds, which requires solving again for
+        the unstable components.
+    """
     self._transform = transform
     self.solver_ctor = solver_ctor
     self.solvers: List[RelaxationSolver] = []
     self._time_limit_millis = time_limit_millis
+    self._num_workers = num_workers
+    self._executor = None
+    self._skip_stable_activation_inputs = skip_stable_activation_inputs
+    # Variables (with their constraints) not yet encoded into the solvers.
+    self._pending_variables: List[RelaxVariable] = []
+
+  def close(self):
+    """Stops the worker processes, if any has been started."""
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def finalize(self):
+    """Encodes into the solvers the variables not encoded yet.
+
+    Encoding is deferred until the solvers are needed, so that the variables
+    and constraints of successive layers can be added to the solvers in bulk.
+    This is done automatically before optimizing bounds, but needs to be
+    called before using `solvers` directly.
+    """
+    if not self._pending_variables:
+      return
+    constraints = []
+    for var in self._pending_variables:
+      if var.constraints:
+        constraints.extend(var.constraints)
+    for minibatch_index, solver in enumerate(self.solvers):
+      solver.maybe_create_solver_variables(
+          self._pending_variables, minibatch_index)
+      _encode_constraints(solver, constraints, minibatch_index)
+    self._pending_variables = []
 
-  def tight_bounds(self, variable: RelaxVariable) -> ibp.IntervalBound:
+  def tight_bounds(
+      self,
+      variable: RelaxVariable,
+      only_unstable: bool = False,
+  ) -> ibp.IntervalBound:
     """Compute tighter bounds based on the LP relaxation.
 
     Args:
       variable: Variable as created by the base boundprop transform. This is a
-        RelaxVariable that has already been encoded into the solvers.
+        RelaxVariable that has already been passed through this transform.
+      only_unstable: If True, only optimize the components whose base bounds
+        contain zero. The other components keep their base bounds.
     Returns:
       tightened_base_bound: Bounds tightened by optimizing with the LP solver.
     """
-    lbs = []
-    ubs = []
-    for solver in self.solvers:
-      nb_targets = np.prod(variable.shape[1:])
-      sample_lbs = []
-      sample_ubs = []
-      for target_idx in range(nb_targets):
-        objective = (jnp.arange(nb_targets) == target_idx).astype(jnp.float32)
-        lb, _, optimal_lb = solver.minimize_objective(
-            variable.name, objective, 0., self._time_limit_millis)
-        assert optimal_lb
-        neg_ub, _, optimal_ub = solver.minimize_objective(
-            variable.name, -objective, 0., self._time_limit_millis)
-        assert optimal_ub
-        sample_lbs.append(lb)
-        sample_ubs.append(-neg_ub)
-      lbs.append(sample_lbs)
-      ubs.append(sample_ubs)
-
+    self.finalize()
+    nb_targets = int(np.prod(variable.shape[1:]))
+    # Start from the base bounds, which are kept for the components that are
+    # not optimized. The bounds are kept in the precision of the solvers, so
+    # that the boxes given back to them do not cut off feasible points.
+    base_lower = np.reshape(
+        np.asarray(variable.base_bound.lower), [-1, nb_targets])
+    base_upper = np.reshape(
+        np.asarray(variable.base_bound.upper), [-1, nb_targets])
+    lbs = base_lower.astype(np.float64)
+    ubs = base_upper.astype(np.float64)
+    if only_unstable:
+      targets = [np.flatnonzero(unstable)
+                 for unstable in (lbs < 0.) & (ubs > 0.)]
+    else:
+      targets = itertools.repeat(None)
+    solve_args = (itertools.repeat(variable.name),
+                  itertools.repeat(nb_targets),
+                  targets,
+                  itertools.repeat(self._time_limit_millis))
+    if self._num_workers:
+      # Each sample has its own independent problem, so they can be solved in
+      # parallel.
+      if self._executor is None:
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=self._num_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+      sample_bounds = self._executor.map(
+          _solve_sample_bounds, self.solvers, *solve_args)
+    else:
+      sample_bounds = map(_solve_sample_bounds, self.solvers, *solve_args)
+
+    for i, (solver, sample_targets, (sample_lbs, sample_ubs)) in enumerate(
+        zip(self.solvers, targets, sample_bounds)):
+      sample_targets = (slice(None) if sample_targets is None
+                        else sample_targets)
+      lbs[i, sample_targets] = sample_lbs
+      ubs[i, sample_targets] = sample_ubs
+      # Keep the solvers up to date so that they do not need to be rebuilt.
+      solver.update_variable_bounds(variable.name, lbs[i], ubs[i])
+
+    lbs, ubs = _cast_outwards(lbs, ubs, base_lower.dtype)
     tightened_base_bound = ibp.IntervalBound(
-        jnp.reshape(jnp.array(lbs), variable.shape),
-        jnp.reshape(jnp.array(ubs), variable.shape))
+        jnp.asarray(lbs).reshape(variable.shape),
+        jnp.asarray(ubs).reshape(variable.shape))
     return tightened_base_bound
 
   def input_transform(
@@ -698,10 +1411,28 @@ class OptimizedRelaxationTransform(
       # will have different constraints.
       if minibatch_index >= len(self.solvers):
         self.solvers.append(self.solver_ctor())
-      solver = self.solvers[minibatch_index]
-      solver.maybe_create_solver_variable(in_bounds, minibatch_index)
+    self._pending_variables.append(in_bounds)
     return in_bounds
 
+  def _activation_input(
+      self, arg: Union[RelaxVariable, Tensor],
+  ) -> Union[RelaxVariable, Tensor]:
+    """Input of an activation, only optimized where its sign is unknown.
+
+    The relaxation of the activation is exact wherever the sign of its input
+    is known, so only the other components need to be optimized. The partially
+    optimized bounds are held by a separate variable, with the same name, so
+    that the other users of `arg` still get fully optimized bounds.
+
+    Args:
+      arg: Input of the activation.
+    Returns:
+      Variable to use as input of the activation.
+    """
+    if not isinstance(arg, OptRelaxVariable) or arg.optimized:
+      return arg
+    return RelaxVariable(arg.idx, self.tight_bounds(arg, only_unstable=True))
+
   def primitive_transform(
       self,
       context: bound_propagation.TransformContext,
@@ -709,22 +1440,16 @@ class OptimizedRelaxationTransform(
       *args: Union[RelaxVariable, Tensor],
       **params,
   ) -> RelaxVariable:
+    if self._skip_stable_activation_inputs and primitive in _activation_list:
+      args = [self._activation_input(arg) for arg in args]
     basic_relax_var = self._transform.equation_transform(
         context, primitive, *args, **params)
     opt_relax_var = OptRelaxVariable(basic_relax_var, self)
 
-    for minibatch_index, solver in enumerate(self.solvers):
-      # Encode the new variable and the associated constraints. We encode the
-      # basic variable, not the optimized one. This way, the optimization is
-      # only performed if the lower / upper bounds are required and the bounds
-      # on that variable are accessed "from outside".
-      solver.maybe_create_solver_variable(basic_relax_var, minibatch_index)
-      if basic_relax_var.constraints:
-        for constraint in basic_relax_var.constraints:
-          if isinstance(constraint, MIPActivationConstraint):
-            # create manually the binary variable because it is not collected
-            # automatically by the graph propagation.
-            solver.maybe_create_solver_variable(
-                constraint.binvar, minibatch_index)
-          constraint.encode_into_solver(solver, minibatch_index)
+    # Record the new variable and the associated constraints, to be encoded
+    # in the solvers once they are needed. We encode the basic variable, not
+    # the optimized one. This way, the optimization is only performed if the
+    # lower / upper bounds are required and the bounds on that variable are
+    # accessed "from outside".
+    self._pending_variables.append(basic_relax_var)
     return opt_relax_var
@@ -606,8 +606,10 @@ def group_linear_sequence(graph: jax.core.Jaxpr,
 
     if is_linear_result[outvar]:
       # This is a Linear operation. Let's construct it, possibly including
-      # previous linear operations that were waiting to be folded in.
-      lin_invars = set()
+      # previous linear operations that were waiting to be folded in. The
+      # inputs are kept in a dict, used as an ordered set, so that their order
+      # is deterministic.
+      lin_invars = {}
       linear_eqns = []
       for invar in eqn.invars:
         if isinstance(invar, jax.core.Var):
@@ -616,11 +618,11 @@ def group_linear_sequence(graph: jax.core.Jaxpr,
           if invar in to_be_folded:
             subg = to_be_folded[invar]
             for sub_invar in subg.invars:
-              lin_invars.add(sub_invar)
+              lin_invars[sub_invar] = None
             linear_eqns.extend(subg.eqns)
             del to_be_folded[invar]
           else:
-            lin_invars.add(invar)
+            lin_invars[invar] = None
 
       lin_outvars = [outvar]
       lin_invars = list(lin_invars)
@@ -16,6 +16,8 @@
 """Tests for solving the convex relaxation using CVXPY."""
 
 import functools
+import pickle
+from unittest import mock
 
 from absl.testing import absltest
 from absl.testing import parameterized
@@ -27,6 +29,17 @@ import jax_verify
 from jax_verify.src import bound_propagation
 from jax_verify.src.mip_solver import cvxpy_relaxation_solver
 from jax_verify.src.mip_solver import relaxation
+import numpy as np
+
+
+class _CountingCvxpySolver(cvxpy_relaxation_solver.CvxpySolver):
+  """CvxpySolver counting the objectives minimized by all its instances."""
+
+  nb_objectives = 0
+
+  def minimize_objectives(self, var_name, objectives, *args, **kwargs):
+    _CountingCvxpySolver.nb_objectives += len(objectives)
+    return super().minimize_objectives(var_name, objectives, *args, **kwargs)
 
 
 class CVXPYRelaxationTest(parameterized.TestCase):
@@ -64,6 +77,33 @@ class CVXPYRelaxationTest(parameterized.TestCase):
 
     return jnp.array(lower_bounds), jnp.array(upper_bounds)
 
+  def _relu_network_fun(self, hidden_sizes, z):
+    def relu_network(inp):
+      for size in hidden_sizes:
+        inp = jax.nn.relu(hk.Linear(size)(inp))
+      return hk.Linear(2)(inp)
+
+    network = hk.without_apply_rng(
+        hk.transform(relu_network, apply_rng=True))
+    return functools.partial(
+        network.apply, network.init(jax.random.PRNGKey(1), z))
+
+  def _encode_relu_relaxation(self):
+    def relu_model(inp):
+      return jax.nn.relu(inp)
+    z = jnp.array([[-2., 3.]])
+
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+    relaxation_transform = relaxation.RelaxationTransform(
+        jax_verify.ibp_transform)
+    var, env = bound_propagation.bound_propagation(
+        bound_propagation.ForwardPropagationAlgorithm(relaxation_transform),
+        relu_model, input_bounds)
+    solver = relaxation.encode_relaxation(
+        cvxpy_relaxation_solver.CvxpySolver, env, 0)
+    objectives = np.concatenate([np.eye(2), -np.eye(2)], axis=0)
+    return var, solver, objectives
+
   def test_linear_cvxpy_relaxation(self):
 
     def linear_model(inp):
@@ -125,6 +165,97 @@ class CVXPYRelaxationTest(parameterized.TestCase):
     self.assertAlmostEqual(8., lower_bounds)
     self.assertAlmostEqual(16., upper_bounds)
 
+  def test_strided_conv2d_cvxpy_relaxation(self):
+    def conv2d_model(inp):
+      return hk.Conv2D(output_channels=2, kernel_shape=(3, 3),
+                       padding='SAME', stride=2, with_bias=True)(inp)
+    z = jax.random.normal(jax.random.PRNGKey(0), (1, 4, 4, 2))
+
+    params = {'conv2_d':
+              {'w': jax.random.normal(jax.random.PRNGKey(1), (3, 3, 2, 2)),
+               'b': jnp.array([2., -1.])}}
+
+    fun = functools.partial(
+        hk.without_apply_rng(hk.transform(conv2d_model, apply_rng=True)).apply,
+        params)
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+
+    lower_bounds, upper_bounds = self.get_bounds(fun, input_bounds)
+    # The interval bounds are exact for a single affine layer.
+    ibp_bounds = jax_verify.interval_bound_propagation(fun, input_bounds)
+    self.assertAlmostEqual(
+        jnp.abs(jnp.ravel(ibp_bounds.lower) - lower_bounds).max(), 0.,
+        delta=1e-4)
+    self.assertAlmostEqual(
+        jnp.abs(jnp.ravel(ibp_bounds.upper) - upper_bounds).max(), 0.,
+        delta=1e-4)
+
+  def test_batched_constant_cvxpy_relaxation(self):
+    bias = jnp.array([[1., -2.], [3., 0.5]])
+    def add_model(inp):
+      return inp + bias
+    z = jnp.array([[1., 2.], [-1., 0.]])
+
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+    relaxation_transform = relaxation.RelaxationTransform(
+        jax_verify.ibp_transform)
+    var, env = bound_propagation.bound_propagation(
+        bound_propagation.ForwardPropagationAlgorithm(relaxation_transform),
+        add_model, input_bounds)
+
+    # Each sample of the batch has its own bias.
+    objectives = np.concatenate([np.eye(2), -np.eye(2)], axis=0)
+    for index in range(2):
+      solver = relaxation.encode_relaxation(
+          cvxpy_relaxation_solver.CvxpySolver, env, index)
+      vals, statuses = solver.minimize_objectives(
+          var.name, objectives, 0., None)
+      self.assertTrue(np.all(statuses))
+      expected = z[index] + bias[index]
+      self.assertArrayAlmostEqual(
+          jnp.concatenate([expected - 1., -expected - 1.]), vals)
+
+  def test_batched_scale_cvxpy_relaxation(self):
+    scale = jnp.array([[1., -2.], [3., 0.5]])
+    def mul_model(inp):
+      return inp * scale
+    z = jnp.array([[1., 2.], [-1., 0.]])
+
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+    relaxation_transform = relaxation.RelaxationTransform(
+        jax_verify.ibp_transform)
+    with self.assertRaises(NotImplementedError):
+      bound_propagation.bound_propagation(
+          bound_propagation.ForwardPropagationAlgorithm(relaxation_transform),
+          mul_model, input_bounds)
+
+  def test_linear_cache_cvxpy_relaxation(self):
+    weight = jax.random.normal(jax.random.PRNGKey(0), (3, 3))
+    def shared_layer_model(layer_weight, inp):
+      out = jnp.dot(inp, layer_weight)
+      for _ in range(2):
+        out = jnp.dot(jax.nn.relu(out), layer_weight)
+      return out
+    z = jnp.array([[1., 2., -1.]])
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+
+    def bounds_and_nb_linear_calls(layer_weight):
+      with mock.patch.object(relaxation, '_get_linear',
+                             wraps=relaxation._get_linear) as get_linear:
+        lower_bounds, upper_bounds = self.get_bounds(
+            functools.partial(shared_layer_model, layer_weight), input_bounds)
+      return lower_bounds, upper_bounds, get_linear.call_count
+
+    lower_bounds, upper_bounds, nb_calls = bounds_and_nb_linear_calls(weight)
+    # Numpy constants could be modified in place, so they are not cached.
+    np_lower_bounds, np_upper_bounds, np_nb_calls = bounds_and_nb_linear_calls(
+        np.asarray(weight))
+
+    self.assertEqual(1, nb_calls)
+    self.assertEqual(3, np_nb_calls)
+    self.assertArrayAlmostEqual(np_lower_bounds, lower_bounds)
+    self.assertArrayAlmostEqual(np_upper_bounds, upper_bounds)
+
   def test_relu_cvxpy_relaxation(self):
     def relu_model(inp):
       return jax.nn.relu(inp)
@@ -136,6 +267,110 @@ class CVXPYRelaxationTest(parameterized.TestCase):
     self.assertArrayAlmostEqual(jnp.array([[0., 2.]]), lower_bounds)
     self.assertArrayAlmostEqual(jnp.array([[0., 4.]]), upper_bounds)
 
+  def test_optimized_relaxation_transform(self):
+    z = jax.random.normal(jax.random.PRNGKey(0), (1, 3))
+    fun = self._relu_network_fun([4], z)
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+
+    optimized_transform = relaxation.OptimizedRelaxationTransform(
+        relaxation.RelaxationTransform(jax_verify.ibp_transform),
+        cvxpy_relaxation_solver.CvxpySolver)
+    output_bounds, _ = bound_propagation.bound_propagation(
+        bound_propagation.ForwardPropagationAlgorithm(optimized_transform),
+        fun, input_bounds)
+
+    # Optimizing the bounds of the first layer does not tighten them, so the
+    # bounds on the output are the ones of the LP relaxation.
+    lower_bounds, upper_bounds = self.get_bounds(fun, input_bounds)
+    self.assertAlmostEqual(
+        jnp.abs(jnp.ravel(output_bounds.lower) - lower_bounds).max(), 0.,
+        delta=1e-4)
+    self.assertAlmostEqual(
+        jnp.abs(jnp.ravel(output_bounds.upper) - upper_bounds).max(), 0.,
+        delta=1e-4)
+
+  def test_optimized_relaxation_transform_workers(self):
+    z = jax.random.normal(jax.random.PRNGKey(0), (2, 3))
+    fun = self._relu_network_fun([4, 4], z)
+    input_bounds = jax_verify.IntervalBound(z - 1., z + 1.)
+
+    def optimized_bounds(**kwargs):
+      with relaxation.OptimizedRelaxationTransform(
+          relaxation.RelaxationTransform(jax_verify.ibp_transform),
+          cvxpy_relaxation_solver.CvxpySolver, **kwargs) as transform:
+        output_bounds, _ = bound_propagation.bound_propagation(
+            bound_propagation.ForwardPropagationAlgorithm(transform),
+            fun, input_bounds)
+        return output_bounds.lower, output_bounds.upper
+
+    serial_lower, serial_upper = optimized_bounds()
+    parallel_lower, parallel_upper = optimized_bounds(num_workers=2)
+    self.assertAlmostEqual(
+        jnp.abs(serial_lower - parallel_lower).max(), 0., delta=1e-5)
+    self.assertAlmostEqual(
+        jnp.abs(serial_upper - parallel_upper).max(), 0., delta=1e-5)
+
+  def test_skip_stable_activation_inputs(self):
+    z = jax.random.normal(jax.random.PRNGKey(0), (1, 3))
+    fun = self._relu_network_fun([8, 8], z)
+    input_bounds = jax_verify.IntervalBound(z - .1, z + .1)
+
+    def optimized_bounds(skip_stable_activation_inputs):
+      _CountingCvxpySolver.nb_objectives = 0
+      transform = relaxation.OptimizedRelaxationTransform(
+          relaxation.RelaxationTransform(jax_verify.ibp_transform),
+          _CountingCvxpySolver,
+          skip_stable_activation_inputs=skip_stable_activation_inputs)
+      output_bounds, _ = bound_propagation.bound_propagation(
+          bound_propagation.ForwardPropagationAlgorithm(transform),
+          fun, input_bounds)
+      return (output_bounds.lower, output_bounds.upper,
+              _CountingCvxpySolver.nb_objectives)
+
+    full_lower, full_upper, full_nb_objectives = optimized_bounds(False)
+    skip_lower, skip_upper, skip_nb_objectives = optimized_bounds(True)
+    # The relaxation of the stable activations is exact, so the output bounds
+    # do not depend on how tight the bounds on their inputs are.
+    self.assertAlmostEqual(
+        jnp.abs(full_lower - skip_lower).max(), 0., delta=1e-5)
+    self.assertAlmostEqual(
+        jnp.abs(full_upper - skip_upper).max(), 0., delta=1e-5)
+    self.assertLess(skip_nb_objectives, full_nb_objectives)
+
+  def test_pickle_cvxpy_solver(self):
+    var, solver, objectives = self._encode_relu_relaxation()
+    vals, _ = solver.minimize_objectives(var.name, objectives, 0., None)
+
+    unpickled_solver = pickle.loads(pickle.dumps(solver))
+    unpickled_vals, statuses = unpickled_solver.minimize_objectives(
+        var.name, objectives, 0., None)
+
+    self.assertTrue(np.all(statuses))
+    self.assertArrayAlmostEqual(vals, unpickled_vals)
+
+  def test_minimize_objectives_cvxpy_relaxation(self):
+    var, solver, objectives = self._encode_relu_relaxation()
+    vals, statuses = solver.minimize_objectives(
+        var.name, objectives, 0., None)
+
+    self.assertTrue(np.all(statuses))
+    self.assertArrayAlmostEqual(jnp.array([0., 2., 0., -4.]), vals)
+
+  def test_update_variable_bounds_cvxpy_relaxation(self):
+    var, solver, objectives = self._encode_relu_relaxation()
+    solver.minimize_objectives(var.name, objectives, 0., None)
+
+    # Tighten the box on the input, which the already built problem needs to
+    # take into account.
+    input_var = var.constraints[0].invar
+    solver.update_variable_bounds(
+        input_var.name, np.array([-3., 2.5]), np.array([-1., 3.5]))
+    vals, statuses = solver.minimize_objectives(
+        var.name, objectives, 0., None)
+
+    self.assertTrue(np.all(statuses))
+    self.assertArrayAlmostEqual(jnp.array([0., 2.5, 0., -3.5]), vals)
+
 
 if __name__ == '__main__':
   absltest.main()